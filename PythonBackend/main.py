@@ -1,14 +1,30 @@
 import asyncio
 import websockets
-import json
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+import orjson
 import base64
+try:
+    # SIMD base64 decode (~10x stdlib); optional, stdlib is the fallback
+    import pybase64
+    _b64decode = pybase64.b64decode
+except ImportError:
+    _b64decode = base64.b64decode
 import logging
+import numpy as np
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part
-import io
-import wave
+from vertexai.caching import CachedContent
 import os
 import re
+import struct
+import threading
+import functools
+import datetime
+import hashlib
+import concurrent.futures
+from collections import OrderedDict
+from xml.sax.saxutils import escape as _xml_escape
+from google.api_core.exceptions import InvalidArgument
 from google.oauth2 import service_account
 import azure.cognitiveservices.speech as speechsdk
 from dotenv import load_dotenv
@@ -20,6 +36,88 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Precomputed 44-byte RIFF/WAVE header for 16kHz 16-bit mono PCM.
+# Only the RIFF size (offset 4) and data size (offset 40) fields need
+# patching per call, which avoids running the wave module's writer state
+# machine on every message.
+_WAV_HEADER_TEMPLATE = struct.pack(
+    '<4sI4s4sIHHIIHH4sI',
+    b'RIFF', 0, b'WAVE',
+    b'fmt ', 16, 1, 1, 16000, 32000, 2, 16,
+    b'data', 0
+)
+
+# Single C-level scan for "contains an English letter", used to spot
+# mixed-language responses without a per-character Python loop
+_ASCII_ALPHA_RE = re.compile(r'[A-Za-z]')
+
+# str.translate table folding CJK codepoints onto private-use markers:
+# kana -> _MARK_KANA, Han codepoints shared by the Japanese and Chinese
+# detection ranges -> _MARK_HAN, Han beyond the Japanese range ->
+# _MARK_HAN_EXT. Private-use markers cannot collide with ordinary response
+# text, and translate + count run as single C passes over the string.
+_MARK_KANA = '\ue000'
+_MARK_HAN = '\ue001'
+_MARK_HAN_EXT = '\ue002'
+_LANG_MARK_TABLE = {cp: ord(_MARK_KANA) for cp in range(0x3040, 0x3100)}
+_LANG_MARK_TABLE.update({cp: ord(_MARK_HAN) for cp in range(0x4E00, 0x9FB0)})
+_LANG_MARK_TABLE.update({cp: ord(_MARK_HAN_EXT) for cp in range(0x9FB0, 0xA000)})
+
+# Service-account credentials parsed once per key file so re-instantiating
+# the backend (tests, hot reload) skips the file read and JWT parsing
+_CREDS_CACHE = {}
+
+# Canonical PING frame and prebuilt PONG reply so keepalives skip JSON
+# parsing and serialization entirely
+_PING_TEXT = '{"type":"PING"}'
+_PONG_BYTES = b'{"type":"PONG"}'
+
+# The model name that succeeded last run is persisted here so restarts
+# try it first instead of probing the whole fallback list
+_MODEL_CACHE_FILE = ".model_cache"
+
+# Raw PCM signaled as audio/L16 lets requests skip the WAV wrapper. If the
+# model rejects the MIME, _generate_sentences latches the backend onto
+# "audio/wav" + convert_pcm_to_wav at runtime and retries.
+_GEMINI_AUDIO_MIME = "audio/L16; rate=16000; channels=1"
+
+# Sentence terminators used to cut the streamed Gemini response into
+# TTS-sized pieces
+_SENTENCE_ENDS = ('.', '!', '?', '\u3002', '\uff01', '\uff1f')
+
+# Canned reply used when Gemini processing fails; its audio is pre-warmed
+# into the TTS cache at startup so the error path costs nothing
+_FALLBACK_TEXT = "Sorry, I couldn't process that. Sumimasen! (excuse me) Try again?"
+
+# Per-language prompt configuration shared by the static tutor prompt and
+# the per-message game context block.
+_LANGUAGE_EXAMPLES = {
+    "japanese": {
+        "name": "Japanese",
+        "examples": "stone is 'ishi' (ee-shee), wood is 'ki' (kee), water is 'mizu' (mee-zoo)",
+        "time_day": "day time (hiru)", 
+        "time_night": "night time (yoru)",
+        "weather_rain": "raining (ame)",
+        "weather_clear": "clear (hareta)"
+    },
+    "spanish": {
+        "name": "Spanish", 
+        "examples": "stone is 'piedra', wood is 'madera', water is 'agua'",
+        "time_day": "day time (día)",
+        "time_night": "night time (noche)", 
+        "weather_rain": "raining (lluvia)",
+        "weather_clear": "clear (despejado)"
+    },
+    "french": {
+        "name": "French",
+        "examples": "stone is 'pierre', wood is 'bois', water is 'eau'", 
+        "time_day": "day time (jour)",
+        "time_night": "night time (nuit)",
+        "weather_rain": "raining (pluie)", 
+        "weather_clear": "clear (clair)"
+    }
+}
+
 class EnhancedLinguavaBackend:
     def __init__(self, project_id: str, key_file_path: str, azure_speech_key: str, azure_speech_region: str, location: str = "us-central1"):
         # Configuration from environment variables
@@ -27,7 +125,15 @@ class EnhancedLinguavaBackend:
         self.key_file_path = key_file_path
         self.location = location
         self.model = None
-        self.connected_clients = set()
+        self.cached_content = None
+        # Guards context-cache recreation after the TTL lapses; pump threads
+        # race to refresh and only one should win
+        self._cache_refresh_lock = threading.Lock()
+        # Set once Gemini init completes; early messages wait on it
+        self._model_ready = asyncio.Event()
+        # Nothing broadcasts, so a plain counter is all the bookkeeping a
+        # connection needs; no hashing or set resizing per connect
+        self._client_count = 0
         self.credentials = None
         
         # Azure Speech configuration from environment
@@ -46,6 +152,53 @@ class EnhancedLinguavaBackend:
         
         # Target language for learning (configurable)
         self.target_language = os.getenv("TARGET_LANGUAGE", "japanese").lower()
+        self._lang_config = _LANGUAGE_EXAMPLES.get(self.target_language, _LANGUAGE_EXAMPLES["japanese"])
+        
+        # Precompiled SSML wrapper for mixed-language synthesis - the voice
+        # never changes after startup
+        self._ssml_template = (
+            '<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">\n'
+            f'    <voice name="{self.voices["english"]}">\n'
+            '        {text}\n'
+            '    </voice>\n'
+            '</speak>'
+        )
+        
+        # Precompiled dynamic-context template; filling it is a single
+        # format_map call per (uncached) message
+        self._context_template = (
+            "CURRENT GAME CONTEXT:\n"
+            "- Player health: {health}/20, hunger: {hunger}/20\n"
+            "- Holding: {held_item}\n"
+            "- Looking at: {target_id} ({target_type})\n"
+            "- Environment: {biome}\n"
+            "- Time: {time}\n"
+            "- Weather: {weather}"
+        )
+        
+        # Exact-match response cache: identical audio clips (repeated short
+        # phrases are common in this workload) skip Gemini and TTS entirely
+        self._response_cache: OrderedDict = OrderedDict()
+        self._response_cache_max = 512
+        
+        # TTS cache keyed on the exact response text - the tutor repeats
+        # itself a lot and the fallback phrase is always the same
+        self._tts_cache: OrderedDict = OrderedDict()
+        self._tts_cache_max = 256
+        
+        # Warm Azure synthesizer connections per voice (built in
+        # _initialize_azure_speech)
+        self._synth_pool_size = 2
+        
+        # Audio format currently accepted by the model; flips to "audio/wav"
+        # if Vertex rejects raw L16 (see _generate_sentences)
+        self._gemini_audio_mime = _GEMINI_AUDIO_MIME
+
+        # Dedicated executor for blocking Gemini calls so they cannot starve
+        # other users of the default thread pool
+        self._gemini_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=16, thread_name_prefix="gemini"
+        )
         
         # Load Google credentials from key file (for Vertex AI)
         self._load_credentials()
@@ -63,6 +216,11 @@ class EnhancedLinguavaBackend:
     def _load_credentials(self):
         """Load service account credentials from key file"""
         try:
+            cached = _CREDS_CACHE.get(self.key_file_path)
+            if cached is not None:
+                self.credentials = cached
+                return
+            
             if not os.path.exists(self.key_file_path):
                 raise FileNotFoundError(f"Key file not found: {self.key_file_path}")
             
@@ -70,6 +228,7 @@ class EnhancedLinguavaBackend:
                 self.key_file_path,
                 scopes=['https://www.googleapis.com/auth/cloud-platform']
             )
+            _CREDS_CACHE[self.key_file_path] = self.credentials
             logger.info(f"Successfully loaded credentials from: {self.key_file_path}")
             
         except Exception as e:
@@ -92,6 +251,38 @@ class EnhancedLinguavaBackend:
                 speechsdk.SpeechSynthesisOutputFormat.Riff16Khz16BitMonoPcm
             )
             
+            # Pre-build a small pool of synthesizers per voice. Each
+            # synthesizer owns its own connection to Azure, so concurrent
+            # requests round-robin across warm connections instead of paying
+            # connection setup per call or serializing on a single stream.
+            # (Vertex AI is left on the SDK's shared channel - the high-level
+            # GenerativeModel API does not expose transport injection.)
+            # The pools emit raw PCM: the streaming path concatenates
+            # sentences, so RIFF headers would corrupt the stream; paths that
+            # need a complete clip wrap it with convert_pcm_to_wav.
+            self._synth_pools = {}
+            self._synth_rr = 0
+            for voice_name in set(self.voices.values()):
+                pool = []
+                for _ in range(self._synth_pool_size):
+                    config = speechsdk.SpeechConfig(
+                        subscription=self.azure_speech_key,
+                        region=self.azure_speech_region
+                    )
+                    config.speech_synthesis_voice_name = voice_name
+                    config.set_speech_synthesis_output_format(
+                        speechsdk.SpeechSynthesisOutputFormat.Raw16Khz16BitMonoPcm
+                    )
+                    synthesizer = speechsdk.SpeechSynthesizer(speech_config=config, audio_config=None)
+                    try:
+                        # Open the websocket to Azure now so the first
+                        # synthesis on this voice skips connection setup
+                        speechsdk.Connection.from_speech_synthesizer(synthesizer).open(True)
+                    except Exception as e:
+                        logger.warning(f"Pre-connect failed for voice {voice_name}: {e}")
+                    pool.append(synthesizer)
+                self._synth_pools[voice_name] = pool
+            
             logger.info(f"Azure Speech initialized with voice: {self.speech_config.speech_synthesis_voice_name}")
             
         except Exception as e:
@@ -107,10 +298,31 @@ class EnhancedLinguavaBackend:
             "gemini-1.5-pro"             # Fallback option
         ]
         
+        # Try the model that worked last run first so restarts skip probing
+        try:
+            with open(_MODEL_CACHE_FILE) as f:
+                cached_name = f.read().strip()
+            if cached_name:
+                model_options = [cached_name] + [m for m in model_options if m != cached_name]
+        except OSError:
+            pass
+        
+        # The tutor instructions never change per message; sending them as the
+        # same leading Part on every request lets Vertex reuse its prompt
+        # prefix cache instead of treating each prompt as unique
+        self._system_prompt_part = Part.from_text(self._build_system_prompt())
+        
         for model_name in model_options:
             try:
                 self.model = GenerativeModel(model_name)
                 logger.info(f"Successfully initialized model: {model_name}")
+                self._model_name = model_name
+                self._initialize_context_cache(model_name)
+                try:
+                    with open(_MODEL_CACHE_FILE, "w") as f:
+                        f.write(model_name)
+                except OSError:
+                    pass
                 return
             except Exception as e:
                 logger.warning(f"Failed to initialize {model_name}: {e}")
@@ -124,43 +336,65 @@ class EnhancedLinguavaBackend:
         logger.error("3. Your project has access to Gemini models")
         raise RuntimeError("Could not initialize any Gemini model")
 
+    def _initialize_context_cache(self, model_name: str):
+        """Pin the static tutor prompt in Vertex's context cache if supported"""
+        try:
+            self.cached_content = CachedContent.create(
+                model_name=model_name,
+                system_instruction=self._build_system_prompt(),
+                ttl=datetime.timedelta(hours=1)
+            )
+            self.model = GenerativeModel.from_cached_content(self.cached_content)
+            logger.info("Context cache created for static tutor prompt")
+        except Exception as e:
+            # Not all models/projects support context caching; the per-request
+            # prompt prefix Part still gets prefix-cache hits server side
+            self.cached_content = None
+            self.model = GenerativeModel(model_name)
+            logger.info(f"Context caching unavailable ({e}); sending prompt prefix per request")
+
     def create_context_prompt(self, game_state: dict) -> str:
         """Create contextual prompt based on game state"""
         player = game_state.get("player", {})
         target = game_state.get("target", {})
         world = game_state.get("world", {})
         
-        # Customize prompt based on target language
-        language_examples = {
-            "japanese": {
-                "name": "Japanese",
-                "examples": "stone is 'ishi' (ee-shee), wood is 'ki' (kee), water is 'mizu' (mee-zoo)",
-                "time_day": "day time (hiru)", 
-                "time_night": "night time (yoru)",
-                "weather_rain": "raining (ame)",
-                "weather_clear": "clear (hareta)"
-            },
-            "spanish": {
-                "name": "Spanish", 
-                "examples": "stone is 'piedra', wood is 'madera', water is 'agua'",
-                "time_day": "day time (día)",
-                "time_night": "night time (noche)", 
-                "weather_rain": "raining (lluvia)",
-                "weather_clear": "clear (despejado)"
-            },
-            "french": {
-                "name": "French",
-                "examples": "stone is 'pierre', wood is 'bois', water is 'eau'", 
-                "time_day": "day time (jour)",
-                "time_night": "night time (nuit)",
-                "weather_rain": "raining (pluie)", 
-                "weather_clear": "clear (clair)"
-            }
-        }
+        # Only these fields feed the prompt, so identical keys mean an
+        # identical prompt - memoize on the tuple instead of rebuilding
+        key = (
+            player.get('health', 'unknown'),
+            player.get('hunger', 'unknown'),
+            player.get('heldItem', 'nothing'),
+            target.get('id', 'nothing'),
+            target.get('type', 'none'),
+            world.get('biome', 'unknown'),
+            world.get('timeOfDay', 0) > 13000,
+            world.get('isRaining', False)
+        )
+        return self._build_prompt(key)
+
+    @functools.lru_cache(maxsize=256)
+    def _build_prompt(self, key: tuple) -> str:
+        """Build the dynamic game-context block for a game-state key tuple"""
+        health, hunger, held_item, target_id, target_type, biome, is_night, is_raining = key
         
-        lang_config = language_examples.get(self.target_language, language_examples["japanese"])
+        lang_config = self._lang_config
+        return self._context_template.format_map({
+            "health": health,
+            "hunger": hunger,
+            "held_item": held_item,
+            "target_id": target_id,
+            "target_type": target_type,
+            "biome": str(biome).replace('minecraft:', '').replace('_', ' '),
+            "time": lang_config['time_night'] if is_night else lang_config['time_day'],
+            "weather": lang_config['weather_rain'] if is_raining else lang_config['weather_clear']
+        })
+
+    def _build_system_prompt(self) -> str:
+        """Build the static tutor instructions that never vary per message"""
+        lang_config = self._lang_config
         
-        prompt = f"""You are a friendly, enthusiastic language tutor helping someone learn {lang_config['name']} while playing Minecraft. 
+        return f"""You are a friendly, enthusiastic language tutor helping someone learn {lang_config['name']} while playing Minecraft. 
 
 IMPORTANT GUIDELINES:
 - Keep responses SHORT (1-2 sentences max)
@@ -170,14 +404,6 @@ IMPORTANT GUIDELINES:
 - Include relevant {lang_config['name']} vocabulary for Minecraft items/actions
 - Be encouraging and supportive
 
-CURRENT GAME CONTEXT:
-- Player health: {player.get('health', 'unknown')}/20, hunger: {player.get('hunger', 'unknown')}/20
-- Holding: {player.get('heldItem', 'nothing')}
-- Looking at: {target.get('id', 'nothing')} ({target.get('type', 'none')})
-- Environment: {world.get('biome', 'unknown').replace('minecraft:', '').replace('_', ' ')}
-- Time: {lang_config['time_night'] if world.get('timeOfDay', 0) > 13000 else lang_config['time_day']}
-- Weather: {lang_config['weather_rain'] if world.get('isRaining', False) else lang_config['weather_clear']}
-
 RESPONSE FORMAT:
 - Start with natural English conversation
 - Include 1-2 relevant {lang_config['name']} words/phrases with pronunciation
@@ -185,24 +411,28 @@ RESPONSE FORMAT:
 - Example: "Nice stone! In {lang_config['name']}, {lang_config['examples'].split(',')[0]}. What are you building?"
 
 Respond naturally like you're playing alongside them!"""
-        
-        return prompt
 
     def detect_language_in_text(self, text: str) -> str:
         """Detect primary language in response text"""
-        # Simple detection based on character patterns
-        japanese_chars = re.findall(r'[\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF]', text)
-        chinese_chars = re.findall(r'[\u4E00-\u9FFF]', text)
-        
-        if japanese_chars and len(japanese_chars) > 3:
+        # Classify codepoints in one C-level translate pass, then count the
+        # markers - no Python loop over characters and no regex machinery
+        marks = text.translate(_LANG_MARK_TABLE)
+        han = marks.count(_MARK_HAN)
+        if marks.count(_MARK_KANA) + han > 3:
             return "japanese"
-        elif chinese_chars and len(chinese_chars) > 3:
+        if han + marks.count(_MARK_HAN_EXT) > 3:
             return "chinese"
-        else:
-            return "english"
+        return "english"
 
     async def text_to_speech_smart(self, text: str) -> bytes:
         """Convert text to speech with smart language detection and voice switching"""
+        # Exact-match cache: re-synthesizing a repeated phrase costs a full
+        # Azure round-trip for identical bytes
+        cached = self._tts_cache.get(text)
+        if cached is not None:
+            self._tts_cache.move_to_end(text)
+            return cached
+        
         try:
             # Detect if text contains non-English content
             detected_lang = self.detect_language_in_text(text)
@@ -210,189 +440,569 @@ Respond naturally like you're playing alongside them!"""
             # Choose appropriate voice
             voice_name = self.voices.get(detected_lang, self.voices["english"])
             
-            # Create speech config
-            speech_config = speechsdk.SpeechConfig(
-                subscription=self.azure_speech_key,
-                region=self.azure_speech_region
-            )
-            
             # For mixed language content, use SSML for better pronunciation
-            if detected_lang != "english" and any(char.isascii() and char.isalpha() for char in text):
+            if detected_lang != "english" and _ASCII_ALPHA_RE.search(text) is not None:
                 # Mixed content - use SSML
                 ssml_text = self._create_mixed_language_ssml(text, voice_name)
-                return await self._synthesize_ssml(ssml_text, speech_config)
+                audio = await self._synthesize_ssml(ssml_text)
             else:
                 # Single language - use regular synthesis
-                speech_config.speech_synthesis_voice_name = voice_name
-                speech_config.set_speech_synthesis_output_format(
-                    speechsdk.SpeechSynthesisOutputFormat.Riff16Khz16BitMonoPcm
-                )
-                
-                synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-                result = synthesizer.speak_text_async(text).get()
+                synthesizer = self._get_synthesizer(voice_name)
+                # .get() blocks for the full synthesis round-trip - run it in
+                # a worker thread so the event loop keeps serving other clients
+                result = await asyncio.to_thread(synthesizer.speak_text_async(text).get)
                 
                 if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-                    return result.audio_data
+                    # Pooled synthesizers emit raw PCM; callers and the TTS
+                    # cache expect complete WAV clips
+                    audio = self.convert_pcm_to_wav(result.audio_data)
                 else:
-                    logger.error(f"Speech synthesis failed: {result.reason}")
+                    logger.error("Speech synthesis failed: %s", result.reason)
                     return b""
+            
+            if audio:
+                self._tts_cache[text] = audio
+                if len(self._tts_cache) > self._tts_cache_max:
+                    self._tts_cache.popitem(last=False)
+            return audio
                 
         except Exception as e:
-            logger.error(f"Error in smart text-to-speech: {e}")
+            logger.error("Error in smart text-to-speech: %s", e)
             return b""
 
     def _create_mixed_language_ssml(self, text: str, primary_voice: str) -> str:
         """Create SSML for mixed language content"""
-        # Simple SSML wrapper - could be enhanced for better language detection
-        english_voice = self.voices["english"]
-        
-        ssml = f'''<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">
-    <voice name="{english_voice}">
-        {text}
-    </voice>
-</speak>'''
-        return ssml
+        # Escape the LLM text - a stray & or < would otherwise break the
+        # SSML document (and saxutils does it in one pass)
+        return self._ssml_template.format(text=_xml_escape(text))
+
+    def _get_synthesizer(self, voice_name: str) -> "speechsdk.SpeechSynthesizer":
+        """Round-robin over the warm synthesizer pool for a voice"""
+        pool = self._synth_pools[voice_name]
+        self._synth_rr = (self._synth_rr + 1) % len(pool)
+        return pool[self._synth_rr]
 
-    async def _synthesize_ssml(self, ssml_text: str, speech_config) -> bytes:
+    async def _synthesize_ssml(self, ssml_text: str) -> bytes:
         """Synthesize SSML text"""
         try:
-            speech_config.set_speech_synthesis_output_format(
-                speechsdk.SpeechSynthesisOutputFormat.Riff16Khz16BitMonoPcm
-            )
-            
-            synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-            result = synthesizer.speak_ssml_async(ssml_text).get()
+            # SSML carries its own <voice> tags, so any pooled synthesizer works
+            synthesizer = self._get_synthesizer(self.voices["english"])
+            result = await asyncio.to_thread(synthesizer.speak_ssml_async(ssml_text).get)
             
             if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-                return result.audio_data
+                return self.convert_pcm_to_wav(result.audio_data)
             else:
-                logger.error(f"SSML synthesis failed: {result.reason}")
+                logger.error("SSML synthesis failed: %s", result.reason)
                 return b""
                 
         except Exception as e:
-            logger.error(f"Error in SSML synthesis: {e}")
+            logger.error("Error in SSML synthesis: %s", e)
             return b""
 
-    async def process_audio_with_gemini(self, audio_data: bytes, context_prompt: str):
-        """Process audio with Gemini API and return both text and audio response"""
+    @staticmethod
+    def _bucket_game_state(game_state: dict) -> tuple:
+        """Quantize game state so near-identical contexts share cache entries"""
+        player = game_state.get("player", {})
+        world = game_state.get("world", {})
+        health = player.get("health")
+        return (
+            int(health) // 5 if isinstance(health, (int, float)) else None,
+            player.get("heldItem"),
+            game_state.get("target", {}).get("id"),
+            world.get("biome"),
+            world.get("timeOfDay", 0) > 13000
+        )
+
+    def _gemini_audio_part(self, audio_data) -> Part:
+        """Build the audio Part in whichever format the model last accepted"""
+        if self._gemini_audio_mime == "audio/wav":
+            return Part.from_data(self.convert_pcm_to_wav(audio_data), mime_type="audio/wav")
+        return Part.from_data(audio_data, mime_type=self._gemini_audio_mime)
+
+    async def _generate_sentences(self, audio_data: bytes, context_prompt: str):
+        """Yield the Gemini response sentence-by-sentence as tokens stream in"""
+        loop = asyncio.get_running_loop()
+        piece_q: asyncio.Queue = asyncio.Queue()
+        
+        # Create audio part for Gemini
+        audio_part = self._gemini_audio_part(audio_data)
+        
+        # With an active context cache the tutor instructions are already
+        # baked into the model; otherwise send them as the shared prefix
+        if self.cached_content is not None:
+            contents = [context_prompt, audio_part]
+        else:
+            contents = [self._system_prompt_part, context_prompt, audio_part]
+        
+        def _pump():
+            emitted = False
+            cache_refreshed = False
+            try:
+                parts = contents
+                while True:
+                    try:
+                        for chunk in self.model.generate_content(parts, stream=True):
+                            try:
+                                piece = chunk.text
+                            except (AttributeError, ValueError):
+                                # safety-filtered or empty candidates have no text
+                                continue
+                            if piece:
+                                emitted = True
+                                loop.call_soon_threadsafe(piece_q.put_nowait, piece)
+                        break
+                    except InvalidArgument as e:
+                        if emitted or self._gemini_audio_mime == "audio/wav":
+                            raise
+                        # Vertex rejected the raw-PCM MIME; latch onto WAV
+                        # for this and all later requests and retry once
+                        logger.warning(
+                            "Gemini rejected %s (%s); falling back to audio/wav",
+                            self._gemini_audio_mime, e
+                        )
+                        self._gemini_audio_mime = "audio/wav"
+                        parts = parts[:-1] + [self._gemini_audio_part(audio_data)]
+                    except Exception as e:
+                        failed_cache = self.cached_content
+                        if emitted or cache_refreshed or failed_cache is None:
+                            raise
+                        # The context cache's 1h TTL has likely lapsed;
+                        # recreate it (or drop back to the prompt-prefix
+                        # path) and retry once
+                        cache_refreshed = True
+                        logger.warning(
+                            "Gemini call failed with context cache active (%s); refreshing cache", e
+                        )
+                        with self._cache_refresh_lock:
+                            if self.cached_content is failed_cache:
+                                self._initialize_context_cache(self._model_name)
+                        if self.cached_content is not None:
+                            parts = [context_prompt, parts[-1]]
+                        else:
+                            parts = [self._system_prompt_part, context_prompt, parts[-1]]
+            except Exception as e:
+                logger.error("Error processing with Gemini: %s", e)
+            finally:
+                loop.call_soon_threadsafe(piece_q.put_nowait, None)
+        
+        pump = loop.run_in_executor(self._gemini_pool, _pump)
+        buffer = ""
         try:
-            # Create audio part for Gemini
-            audio_part = Part.from_data(audio_data, mime_type="audio/wav")
-            
-            # Generate response (run in thread pool since it's not async)
-            import asyncio
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None, 
-                lambda: self.model.generate_content([context_prompt, audio_part])
-            )
-            
-            # Get text response
-            text_response = response.text
-            
-            # Generate audio using smart language detection
-            audio_response = await self.text_to_speech_smart(text_response)
-            
-            return {
-                "text": text_response,
-                "audio": audio_response
-            }
-            
-        except Exception as e:
-            logger.error(f"Error processing with Gemini: {e}")
-            fallback_text = "Sorry, I couldn't process that. Sumimasen! (excuse me) Try again?"
-            return {
-                "text": fallback_text,
-                "audio": await self.text_to_speech_smart(fallback_text)
-            }
-
-    def convert_pcm_to_wav(self, pcm_data: bytes, sample_rate: int = 16000, channels: int = 1, sample_width: int = 2) -> bytes:
+            while True:
+                piece = await piece_q.get()
+                if piece is None:
+                    break
+                buffer += piece
+                while True:
+                    cut = min(
+                        (j for j in (buffer.find(ch) for ch in _SENTENCE_ENDS) if j != -1),
+                        default=-1
+                    )
+                    if cut == -1:
+                        break
+                    # keep trailing whitespace with the sentence so joining
+                    # the pieces reproduces the exact response text
+                    end = cut + 1
+                    while end < len(buffer) and buffer[end].isspace():
+                        end += 1
+                    yield buffer[:end]
+                    buffer = buffer[end:]
+            if buffer:
+                yield buffer
+        finally:
+            await pump
+
+    async def _sentence_audio(self, sentence: str, out_q: asyncio.Queue) -> bytes:
+        """Synthesize one sentence, streaming its PCM to the client
+
+        Returns the sentence's raw PCM so the caller can assemble and cache
+        the full clip.
+        """
+        if not sentence.strip():
+            return b""
+        
+        cached = self._tts_cache.get(sentence)
+        if cached is not None:
+            self._tts_cache.move_to_end(sentence)
+            pcm = cached[44:]
+            if pcm:
+                await out_q.put(pcm)
+            return pcm
+        
+        detected_lang = self.detect_language_in_text(sentence)
+        if detected_lang != "english" and _ASCII_ALPHA_RE.search(sentence) is not None:
+            # Mixed-language content needs the SSML path, which has no
+            # pull-stream variant - synthesize in full and send one chunk
+            wav = await self.text_to_speech_smart(sentence)
+            pcm = wav[44:] if wav else b""
+            if pcm:
+                await out_q.put(pcm)
+            return pcm
+        
+        voice_name = self.voices.get(detected_lang, self.voices["english"])
+        pcm = await self._stream_tts(sentence, voice_name, out_q)
+        if pcm and sentence not in self._tts_cache:
+            self._tts_cache[sentence] = self.convert_pcm_to_wav(pcm)
+            if len(self._tts_cache) > self._tts_cache_max:
+                self._tts_cache.popitem(last=False)
+        return pcm
+
+    async def _stream_tts(self, text: str, voice_name: str, out_q: asyncio.Queue) -> bytes:
+        """Synthesize text and forward raw PCM chunks as Azure produces them
+
+        Returns the full PCM so callers can assemble and cache the clip.
+        """
+        loop = asyncio.get_running_loop()
+        chunk_q: asyncio.Queue = asyncio.Queue()
+        # Pooled synthesizer: its websocket to Azure is already open, so the
+        # sentence skips the per-call connection handshake
+        synthesizer = self._get_synthesizer(voice_name)
+
+        def _pump():
+            try:
+                result = synthesizer.start_speaking_text_async(text).get()
+                stream = speechsdk.AudioDataStream(result)
+                while True:
+                    buf = bytes(4096)
+                    filled = stream.read_data(buf)
+                    if filled == 0:
+                        break
+                    loop.call_soon_threadsafe(chunk_q.put_nowait, buf[:filled])
+                if stream.status == speechsdk.StreamStatus.Canceled:
+                    logger.error(
+                        "Streaming synthesis canceled: %s",
+                        stream.cancellation_details.error_details
+                    )
+                elif logger.isEnabledFor(logging.DEBUG):
+                    try:
+                        first_byte_ms = result.properties.get_property(
+                            speechsdk.PropertyId.SpeechServiceResponse_SynthesisFirstByteLatencyMs
+                        )
+                        logger.debug("TTS first-byte latency: %s ms", first_byte_ms)
+                    except Exception:
+                        pass
+            except Exception as e:
+                logger.error("Error in streaming synthesis: %s", e)
+            finally:
+                # The sentinel must reach the consumer even on failure, or
+                # it blocks on the queue forever
+                loop.call_soon_threadsafe(chunk_q.put_nowait, None)
+        
+        pump = loop.run_in_executor(None, _pump)
+        chunks = []
+        try:
+            while True:
+                chunk = await chunk_q.get()
+                if chunk is None:
+                    break
+                chunks.append(chunk)
+                await out_q.put(chunk)
+        finally:
+            await pump
+        return b"".join(chunks)
+
+    def _store_response(self, cache_key: tuple, text: str, audio: bytes):
+        """Record a successful response in the response and TTS caches"""
+        if not audio or text == _FALLBACK_TEXT:
+            return
+        self._response_cache[cache_key] = (text, audio)
+        if len(self._response_cache) > self._response_cache_max:
+            self._response_cache.popitem(last=False)
+        if text not in self._tts_cache:
+            self._tts_cache[text] = audio
+            if len(self._tts_cache) > self._tts_cache_max:
+                self._tts_cache.popitem(last=False)
+
+    def convert_pcm_to_wav(self, pcm_data: bytes, sample_rate: int = 16000, channels: int = 1, sample_width: int = 2, src_dtype: str = '<i2') -> bytes:
         """Convert raw PCM data to WAV format"""
-        buffer = io.BytesIO()
-        with wave.open(buffer, 'wb') as wav_file:
-            wav_file.setnchannels(channels)
-            wav_file.setsampwidth(sample_width)
-            wav_file.setframerate(sample_rate)
-            wav_file.writeframes(pcm_data)
-        return buffer.getvalue()
-
-    async def handle_client_message(self, websocket, message: str):
+        if src_dtype != '<i2':
+            # Vectorized sample conversion (e.g. float32 or big-endian input)
+            # via NumPy views - no Python loop over samples
+            samples = np.frombuffer(pcm_data, dtype=src_dtype)
+            if samples.dtype.kind == 'f':
+                samples = np.clip(samples * 32767.0, -32768, 32767)
+            pcm_data = samples.astype('<i2').tobytes()
+        
+        if sample_rate == 16000 and channels == 1 and sample_width == 2:
+            # Fast path: patch the length fields of the cached header template
+            header = bytearray(_WAV_HEADER_TEMPLATE)
+            struct.pack_into('<I', header, 4, 36 + len(pcm_data))
+            struct.pack_into('<I', header, 40, len(pcm_data))
+            return b"".join((header, pcm_data))
+
+        # Non-default parameters: build the header with one struct.pack
+        # instead of driving the wave module through a BytesIO
+        header = struct.pack(
+            '<4sI4s4sIHHIIHH4sI',
+            b'RIFF', 36 + len(pcm_data), b'WAVE',
+            b'fmt ', 16, 1, channels, sample_rate,
+            sample_rate * channels * sample_width,
+            channels * sample_width, sample_width * 8,
+            b'data', len(pcm_data)
+        )
+        return b"".join((header, pcm_data))
+
+    async def _writer(self, websocket, out_q: asyncio.Queue):
+        """Drain a client's outbound queue with a single writer task"""
+        try:
+            while True:
+                await websocket.send(await out_q.get())
+                # Drain anything that queued while we were sending so a burst
+                # of responses costs one wakeup instead of one per message
+                while not out_q.empty():
+                    await websocket.send(out_q.get_nowait())
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        # The connection is gone, but producers may still be blocked putting
+        # into a full queue - keep discarding frames so they can finish;
+        # handle_client's finally cancels this task once they're reaped
+        while True:
+            await out_q.get()
+
+    def _spawn_action(self, data: dict, pcm_data, out_q: asyncio.Queue, conn_state: dict):
+        """Schedule a player action concurrently, capped per client"""
+        task = asyncio.create_task(self._bounded_action(data, pcm_data, out_q, conn_state))
+        conn_state["tasks"].add(task)
+        task.add_done_callback(conn_state["tasks"].discard)
+
+    async def _bounded_action(self, data: dict, pcm_data, out_q: asyncio.Queue, conn_state: dict):
+        """Process a player action under the per-client concurrency cap"""
+        async with conn_state["sem"]:
+            try:
+                await self._process_player_action(data, pcm_data, out_q, conn_state["stream_lock"])
+            except Exception as e:
+                # Spawned tasks have no caller to surface errors to; answer
+                # with an ERROR frame like the synchronous path always did
+                logger.error("Error processing player action: %s", e)
+                await out_q.put(orjson.dumps({
+                    "type": "ERROR",
+                    "message": str(e)
+                }))
+
+    async def _send_response(self, out_q: asyncio.Queue, text: str, audio: bytes, timestamp):
+        """Queue a complete AI_RESPONSE header plus its binary audio frame"""
+        # Send a small JSON header followed by the raw audio as a binary
+        # frame - no base64 inflation and no O(N) encode on the event loop
+        await out_q.put(orjson.dumps({
+            "type": "AI_RESPONSE",
+            "text": text,
+            "timestamp": timestamp,
+            "audioBytes": len(audio)
+        }))
+        if audio:
+            await out_q.put(audio)
+        logger.debug("Processed audio request, sent response: %.100s... (with audio: %d bytes)", text, len(audio))
+
+    async def _process_player_action(self, data: dict, pcm_data, out_q: asyncio.Queue, stream_lock: asyncio.Lock):
+        """Run Gemini + TTS for a player action and queue the response"""
+        # Hold actions that arrive before Gemini init finishes
+        await self._model_ready.wait()
+
+        game_state = data.get("gameState", {})
+        timestamp = data.get("timestamp", 0)
+        context_prompt = self.create_context_prompt(game_state)
+
+        # Serve identical audio in a similar game context straight from the
+        # cache; the bucketed context keeps a repeated "what is this?" from
+        # replaying an answer recorded in a different situation
+        audio_digest = hashlib.blake2b(pcm_data, digest_size=16).digest()
+        cache_key = (audio_digest, self._bucket_game_state(game_state))
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            self._response_cache.move_to_end(cache_key)
+            async with stream_lock:
+                await self._send_response(out_q, cached[0], cached[1], timestamp)
+            return
+
+        # The binary PCM chunks carry no response id, so only one response
+        # may be on the wire per connection at a time; concurrent actions
+        # still overlap on the semaphore but take turns streaming out
+        async with stream_lock:
+            # Stream Gemini tokens and synthesize sentence-by-sentence so the
+            # model and TTS network calls overlap instead of running in
+            # series; the full text arrives in the AI_RESPONSE_END trailer
+            await out_q.put(orjson.dumps({
+                "type": "AI_RESPONSE",
+                "timestamp": timestamp,
+                "streaming": True
+            }))
+
+            text_parts = []
+            pcm_parts = []
+            try:
+                async for sentence in self._generate_sentences(pcm_data, context_prompt):
+                    text_parts.append(sentence)
+                    pcm = await self._sentence_audio(sentence, out_q)
+                    if pcm:
+                        pcm_parts.append(pcm)
+            except Exception as e:
+                # The streaming header is already out, so the stream must be
+                # closed with a trailer either way; degrade to the fallback
+                # reply (or whatever sentences made it) instead of raising
+                logger.error("Error generating streamed response: %s", e)
+
+            if not text_parts:
+                # Gemini produced nothing - fall back to the canned reply,
+                # whose audio is pre-warmed in the TTS cache
+                text_parts.append(_FALLBACK_TEXT)
+                pcm = await self._sentence_audio(_FALLBACK_TEXT, out_q)
+                if pcm:
+                    pcm_parts.append(pcm)
+
+            text = "".join(text_parts)
+            pcm = b"".join(pcm_parts)
+            await out_q.put(orjson.dumps({
+                "type": "AI_RESPONSE_END",
+                "text": text,
+                "timestamp": timestamp,
+                "audioBytes": len(pcm)
+            }))
+        self._store_response(cache_key, text, self.convert_pcm_to_wav(pcm) if pcm else b"")
+        logger.debug("Streamed audio response: %.100s... (%d bytes)", text, len(pcm))
+
+    async def handle_client_message(self, websocket, message, out_q: asyncio.Queue, conn_state: dict):
         """Handle incoming message from Minecraft client"""
+        # Fast path: answer keepalives on the raw frame before touching JSON
+        if message == _PING_TEXT:
+            await out_q.put(_PONG_BYTES)
+            return
+        
         try:
-            data = json.loads(message)
+            if isinstance(message, (bytes, bytearray)):
+                # Binary frame: raw PCM belonging to the preceding header
+                # frame - skips the UTF-8 decode, the base64 string inside the
+                # JSON envelope, and the base64 decode entirely
+                pending = conn_state.pop("pending_action", None)
+                if pending is not None:
+                    self._spawn_action(pending, message, out_q, conn_state)
+                    return
+                
+                # Self-contained framing, parsed over a memoryview with no
+                # copies: [4-byte big-endian header length][JSON header][PCM]
+                view = memoryview(message)
+                if len(view) > 4:
+                    header_len = int.from_bytes(view[:4], "big")
+                    if 0 < header_len <= len(view) - 4:
+                        try:
+                            header = orjson.loads(view[4:4 + header_len])
+                        except orjson.JSONDecodeError:
+                            header = None
+                        if header is not None and header.get("type") == "PLAYER_ACTION_WITH_AUDIO":
+                            self._spawn_action(header, bytes(view[4 + header_len:]), out_q, conn_state)
+                            return
+                
+                await out_q.put(orjson.dumps({
+                    "type": "ERROR",
+                    "message": "Unexpected binary frame"
+                }))
+                return
+            
+            data = orjson.loads(message)
             
             if data.get("type") == "PLAYER_ACTION_WITH_AUDIO":
                 # Extract audio data
-                audio_b64 = data.get("audioChunk", "")
+                audio_b64 = data.get("audioChunk")
+                if audio_b64 is None:
+                    # Header-only frame: the raw PCM follows as a binary frame
+                    conn_state["pending_action"] = data
+                    return
                 if not audio_b64:
-                    await websocket.send(json.dumps({
+                    await out_q.put(orjson.dumps({
                         "type": "ERROR",
                         "message": "No audio data received"
                     }))
                     return
                 
-                # Decode audio
-                pcm_data = base64.b64decode(audio_b64)
-                wav_data = self.convert_pcm_to_wav(pcm_data)
-                
-                # Create context prompt
-                context_prompt = self.create_context_prompt(data.get("gameState", {}))
-                
-                # Process with Gemini
-                response_data = await self.process_audio_with_gemini(wav_data, context_prompt)
-                
-                # Send response back to client
-                response = {
-                    "type": "AI_RESPONSE",
-                    "text": response_data["text"],
-                    "audioData": base64.b64encode(response_data["audio"]).decode('utf-8') if response_data["audio"] else "",
-                    "timestamp": data.get("timestamp", 0)
-                }
-                
-                await websocket.send(json.dumps(response))
-                logger.info(f"Processed audio request, sent response: {response_data['text'][:100]}... (with audio: {len(response_data['audio'])} bytes)")
+                # Legacy single-frame path: base64 decode is all that's left
+                self._spawn_action(data, _b64decode(audio_b64, validate=False), out_q, conn_state)
                 
             elif data.get("type") == "PING":
-                await websocket.send(json.dumps({"type": "PONG"}))
+                await out_q.put(orjson.dumps({"type": "PONG"}))
                 
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.error("Invalid JSON received")
-            await websocket.send(json.dumps({
+            await out_q.put(orjson.dumps({
                 "type": "ERROR", 
                 "message": "Invalid JSON format"
             }))
         except Exception as e:
-            logger.error(f"Error handling message: {e}")
-            await websocket.send(json.dumps({
+            logger.error("Error handling message: %s", e)
+            await out_q.put(orjson.dumps({
                 "type": "ERROR",
                 "message": str(e)
             }))
 
     async def handle_client(self, websocket):
         """Handle new client connection"""
-        self.connected_clients.add(websocket)
-        logger.info(f"Client connected. Total clients: {len(self.connected_clients)}")
+        self._client_count += 1
+        logger.debug("Client connected. Total clients: %d", self._client_count)
         
+        out_q = asyncio.Queue(maxsize=64)
+        writer_task = asyncio.create_task(self._writer(websocket, out_q))
+        conn_state = {
+            "sem": asyncio.Semaphore(3),  # cap concurrent Gemini jobs per client
+            # serializes response output: chunks aren't tagged per response
+            "stream_lock": asyncio.Lock(),
+            "tasks": set()
+        }
         try:
             async for message in websocket:
-                await self.handle_client_message(websocket, message)
+                await self.handle_client_message(websocket, message, out_q, conn_state)
         except websockets.exceptions.ConnectionClosed:
             logger.info("Client disconnected")
         except Exception as e:
-            logger.error(f"Error handling client: {e}")
+            logger.error("Error handling client: %s", e)
         finally:
-            self.connected_clients.discard(websocket)
-            logger.info(f"Client removed. Total clients: {len(self.connected_clients)}")
+            for task in conn_state["tasks"]:
+                task.cancel()
+            writer_task.cancel()
+            self._client_count -= 1
+            logger.debug("Client removed. Total clients: %d", self._client_count)
+
+    async def _startup(self):
+        """Model init and cache pre-warm, run concurrently with serving"""
+        await self.initialize_gemini()
+        self._model_ready.set()
+        
+        # Pre-warm the fallback audio so the error path never waits on Azure
+        try:
+            await self.text_to_speech_smart(_FALLBACK_TEXT)
+        except Exception as e:
+            logger.warning(f"Failed to pre-warm fallback audio: {e}")
 
     async def start_server(self, host: str = "localhost", port: int = 8765):
         """Start the WebSocket server"""
-        await self.initialize_gemini()
+        # Initialize Gemini while the socket is already accepting clients;
+        # actions queue on _model_ready until init completes
+        startup_task = asyncio.create_task(self._startup())
         
         logger.info(f"Starting Enhanced Linguava backend server on {host}:{port}")
         logger.info(f"Available voices: {list(self.voices.keys())}")
-        async with websockets.serve(self.handle_client, host, port):
-            logger.info("Server started successfully")
-            await asyncio.Future()  # Run forever
+        try:
+            # Protocol-level keepalives mean well-behaved clients never need
+            # application PINGs at all. The deflate window/memLevel are turned
+            # down from the defaults: raw PCM barely compresses anyway, and
+            # this cuts per-connection compressor RAM from ~256KB to ~16KB so
+            # the server can hold many more idle connections.
+            deflate = ServerPerMessageDeflateFactory(
+                server_max_window_bits=12,
+                compress_settings={"memLevel": 5}
+            )
+            async with websockets.serve(
+                self.handle_client, host, port,
+                ping_interval=20, ping_timeout=20,
+                compression=None, extensions=[deflate]
+            ):
+                logger.info("Server started successfully")
+                # Run forever, but let a failed startup (e.g. no usable
+                # Gemini model) propagate and stop the server
+                await asyncio.gather(startup_task, asyncio.Future())
+        finally:
+            self.close()
+
+    def close(self):
+        """Release background resources held by the backend"""
+        self._gemini_pool.shutdown(wait=False)
 
 async def main():
     """Main function that loads configuration from environment variables"""
@@ -446,4 +1056,10 @@ async def main():
         logger.error("Please check your configuration and try again")
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        # uvloop is not available on Windows; the default loop works fine
+        logger.info("uvloop not available, using default asyncio event loop")
     asyncio.run(main())
\ No newline at end of file